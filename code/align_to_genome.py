@@ -9,6 +9,8 @@ import subprocess
 import shutil
 import sys
 
+import shard_alignments_by_chrom
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
@@ -52,6 +54,17 @@ def main():
       action='store', dest='tophat_max_intron_len',
       default=5000,
       help='Ignore intron candidates larger than this.  Default is for yeast.')
+  parser.add_option(
+      '--tophat_coverage_search',
+      action='store_true', dest='tophat_coverage_search',
+      default=False,
+      help='Re-enable tophat coverage-based junction search (very slow, and '
+           'nothing downstream consumes its extra junctions).')
+  parser.add_option(
+      '--tophat_no_novel_juncs',
+      action='store_true', dest='tophat_no_novel_juncs',
+      default=False,
+      help='Tell tophat to only align across known junctions.')
   parser.add_option(
       '--bowtie_parallelism', type='int',
       action='store', dest='bowtie_parallelism',
@@ -67,27 +80,48 @@ def main():
       action='store', dest='bowtie_max_matches',
       default=1,
       help='If there are more matches than this give up and write to .max.')
+  parser.add_option(
+      '--shard_on_the_fly',
+      action='store_true', dest='shard_on_the_fly',
+      default=False,
+      help='Shard bowtie output by chromosome directly, sorting each shard '
+           'instead of the whole alignment.')
   (options, args) = parser.parse_args()
 
   logging.info('Processing input.')
   input_files = args[:-1]
   output_file_base = args[-1]
+  if options.shard_on_the_fly:
+    if options.treat_as_mrna:
+      logging.fatal('--shard_on_the_fly only works with plain bowtie.')
+      return 2
+    align_and_shard_with_bowtie(input_files,
+                                options.genome,
+                                options.bowtie_path,
+                                options.bowtie_parallelism,
+                                options.bowtie_error_tolerance,
+                                options.bowtie_max_matches,
+                                output_file_base)
+    return
   if options.treat_as_mrna:
     align_to_genome = align_with_tophat
     binary_path = options.tophat_path
   else:
     align_to_genome = align_with_bowtie
     binary_path = options.bowtie_path
-  final_alignment = align_to_genome(input_files,
-                                    options.genome,
-                                    binary_path,
-                                    options.bowtie_parallelism,
-                                    options.bowtie_error_tolerance,
-                                    options.bowtie_max_matches,
-                                    options.tophat_min_anchor_len,
-                                    options.tophat_max_intron_len,
-                                    options.fna_genome,
-                                    output_file_base)
+  final_alignment = align_to_genome(
+      input_files,
+      options.genome,
+      binary_path,
+      options.bowtie_parallelism,
+      options.bowtie_error_tolerance,
+      options.bowtie_max_matches,
+      options.tophat_min_anchor_len,
+      options.tophat_max_intron_len,
+      options.fna_genome,
+      output_file_base,
+      tophat_no_coverage_search=not options.tophat_coverage_search,
+      tophat_no_novel_juncs=options.tophat_no_novel_juncs)
   logging.info('Final alignment file: {0}'.format(final_alignment))
 
 
@@ -100,7 +134,9 @@ def align_with_tophat(input_files,
                       tophat_min_anchor_len,
                       tophat_max_intron_len,
                       fna_genome,
-                      output_file_base):
+                      output_file_base,
+                      tophat_no_coverage_search=True,
+                      tophat_no_novel_juncs=False):
   """Align input sequences in input_file to provided genome using tophat.
   Args:
     input_files: List of fastq files to be processed.
@@ -112,11 +148,13 @@ def align_with_tophat(input_files,
     tophat_min_anchor_len: Minimum anchor length for tophat junctions.
     fna_genome: Reference genome for computing MD tags.
     output_file_base: Base name for output files and tophat dump directory.
+    tophat_no_coverage_search: Skip coverage-based junction search.
+    tophat_no_novel_juncs: Only align across known junctions.
   Returns:
     output_file: Name of the file to which final alignments are written.
   """
   logging.info('Aligning with tophat.')
-  output_file = output_file_base + '.alignment.sam'
+  output_file = output_file_base + '.alignment.bam'
   tophat_stdout_log = open(output_file_base + '.tophat_stdout_genome', 'w')
   tophat_error_log = open(output_file_base + '.tophat_stderr_genome', 'w')
   tophat_dir = output_file_base + '.tophat'
@@ -128,6 +166,12 @@ def align_with_tophat(input_files,
   command.extend(['--num-threads', str(bowtie_parallelism)])
   command.extend(['--output-dir', tophat_dir])
   command.extend(['--segment-mismatches', str(bowtie_error_tolerance)])
+  if tophat_no_coverage_search:
+    # Coverage search is tophat's most expensive stage, and nothing
+    # downstream uses the junctions it discovers.
+    command.extend(['--no-coverage-search'])
+  if tophat_no_novel_juncs:
+    command.extend(['--no-novel-juncs'])
   if not os.path.exists(tophat_dir):
     os.mkdir(tophat_dir)
   # These are positional arguments, and should be last.
@@ -142,25 +186,30 @@ def align_with_tophat(input_files,
     logging.fatal('No such file: {0}'.format(bam_file))
   if not os.path.exists(fna_genome):
     logging.fatal('No such file: {0}'.format(fna_genome))
-  # Run output through samtools fillmd.
-  sam_file = open(os.path.splitext(bam_file)[0] + '.sam', 'w')
-  command = ['samtools', 'fillmd']
+  # Add MD tags and sort, staying in BAM the whole way -- calmd streams
+  # straight into the sorter, so the big alignment file never hits disk as
+  # text SAM.  Note samtools sorts by position only; the per-strand
+  # grouping analyze_shards needs is restored per shard by
+  # shard_alignments_by_chrom.sort_shard_files.
+  command = ['samtools', 'calmd', '-b']
   command.append(bam_file)
   command.append(fna_genome)
-  logging.info(' '.join(command) + ' > ' + sam_file.name)
-  subprocess.check_call(command,
-                        stdout=sam_file)
-  sam_file.close()
-  # Sort the SAM output back to top level workspace.
-  command = ['sort']
-  command.extend(['-k', '3d,3'])
-  command.extend(['-k', '2g,2'])
-  command.extend(['-k', '4g,4'])
-  command.append(sam_file.name)
-  with open(output_file, 'w') as output:
-    logging.info(' '.join(command) + ' > ' + output_file)
-    subprocess.check_call(command,
-                          stdout=output)
+  sort_command = ['samtools', 'sort']
+  sort_command.extend(['-@', str(bowtie_parallelism)])
+  sort_command.extend(['-m', '1G'])
+  sort_command.extend(['-O', 'bam'])
+  sort_command.extend(['-o', output_file])
+  sort_command.append('-')
+  logging.info(' '.join(command) + ' | ' + ' '.join(sort_command))
+  calmd = subprocess.Popen(command,
+                           stdout=subprocess.PIPE)
+  sorter = subprocess.Popen(sort_command,
+                            stdin=calmd.stdout)
+  calmd.stdout.close()
+  if sorter.wait() != 0:
+    raise subprocess.CalledProcessError(sorter.returncode, sort_command)
+  if calmd.wait() != 0:
+    raise subprocess.CalledProcessError(calmd.returncode, command)
   return output_file
 
 
@@ -173,7 +222,9 @@ def align_with_bowtie(input_files,
                       tophat_min_anchor_len,
                       tophat_max_intron_len,
                       fna_genome,
-                      output_file_base):
+                      output_file_base,
+                      tophat_no_coverage_search=True,
+                      tophat_no_novel_juncs=False):
   """Align input sequences in input_file to provided genome with just bowtie.
   Args:
     input_files: List of fastq files to be processed.
@@ -186,13 +237,13 @@ def align_with_bowtie(input_files,
     tophat_max_intron_len: Ignored.
     fna_genome: Ignored.
     output_file_base: Base name for output files.
+    tophat_no_coverage_search: Ignored.
+    tophat_no_novel_juncs: Ignored.
   Returns:
     output_file: Name of the file to which final alignments are written.
   """
   logging.info('Aligning with bowtie.')
   output_file = output_file_base + '.alignment.sam'
-  unsorted_output = output_file + '.unsorted'
-  bowtie_stdout_log = open(output_file_base + '.bowtie_stdout_genome', 'w')
   bowtie_stderr_log = open(output_file_base + '.bowtie_stderr_genome', 'w')
   unmatchable_seqs = output_file_base + '.unmatchable'
   max_excluded_file = output_file_base + '.toomany'
@@ -202,29 +253,101 @@ def align_with_bowtie(input_files,
   command.extend(['-v', str(bowtie_error_tolerance)])
   command.extend(['-m', str(bowtie_max_matches)])
   command.extend(['--sam'])
-  command.extend(['--sam-nohead'])
+  # Memory-map the index so concurrent bowtie processes on this host share
+  # one copy through the page cache instead of each loading their own.
+  command.extend(['--mm'])
   command.extend(['--un', unmatchable_seqs])
   command.extend(['--max', max_excluded_file])
-  # These three are actual arguments, and need to be last.
+  # These two are actual arguments, and need to be last.  With no output
+  # argument, bowtie streams SAM to stdout, which we feed straight into the
+  # sorter -- no unsorted temp file.  (samtools sort needs the @SQ headers to
+  # resolve reference names, so no more --sam-nohead.)  samtools sorts by
+  # position only; the per-strand grouping analyze_shards needs is restored
+  # per shard by shard_alignments_by_chrom.sort_shard_files.
   command.extend([genome])
   command.extend([','.join(input_files)])
-  command.extend([unsorted_output])
-  logging.info(' '.join(command))
-  subprocess.check_call(command,
-                        stdout=bowtie_stdout_log,
-                        stderr=bowtie_stderr_log)
-  command = ['sort']
-  command.extend(['-k', '3d,3'])
-  command.extend(['-k', '2g,2'])
-  command.extend(['-k', '4g,4'])
-  command.append(unsorted_output)
-  with open(output_file, 'w') as output:
-    logging.info(' '.join(command) + ' > ' + output_file)
-    subprocess.check_call(command,
-                          stdout=output)
+  sort_command = ['samtools', 'sort']
+  sort_command.extend(['-@', str(bowtie_parallelism)])
+  sort_command.extend(['-m', '1G'])
+  sort_command.extend(['-O', 'sam'])
+  sort_command.extend(['-o', output_file])
+  sort_command.append('-')
+  logging.info(' '.join(command) + ' | ' + ' '.join(sort_command))
+  bowtie = subprocess.Popen(command,
+                            stdout=subprocess.PIPE,
+                            stderr=bowtie_stderr_log)
+  sorter = subprocess.Popen(sort_command,
+                            stdin=bowtie.stdout)
+  bowtie.stdout.close()
+  if sorter.wait() != 0:
+    raise subprocess.CalledProcessError(sorter.returncode, sort_command)
+  if bowtie.wait() != 0:
+    raise subprocess.CalledProcessError(bowtie.returncode, command)
   return output_file
 
 
+def align_and_shard_with_bowtie(input_files,
+                                genome,
+                                binary_path,
+                                bowtie_parallelism,
+                                bowtie_error_tolerance,
+                                bowtie_max_matches,
+                                output_file_base):
+  """Align with bowtie and shard the output by chromosome in one pass.
+
+  Bowtie's stdout streams straight into the sharder, so the giant
+  globally-sorted SAM never exists.  The shards land in bowtie read
+  order, which analyze_shards can't use (it expects strand-grouped,
+  position-sorted input), so each shard is re-sorted by (FLAG, POS)
+  before we return -- many small parallel sorts instead of one big one.
+  Args:
+    input_files: List of fastq files to be processed.
+    genome: The bowtie index of the genome to align against.
+    binary_path: Path to the bowtie binary.
+    bowtie_parallelism: Number of processes bowtie should use.
+    bowtie_error_tolerance: Number of alignment errors tolerated per sequence.
+    bowtie_max_matches: Maximum allowable matches before fail-fast.
+    output_file_base: Base name for output files.
+  Returns:
+    total_aligned: Number of alignments written across all shards.
+  """
+  logging.info('Aligning with bowtie, sharding on the fly.')
+  bowtie_stderr_log = open(output_file_base + '.bowtie_stderr_genome', 'w')
+  unmatchable_seqs = output_file_base + '.unmatchable'
+  max_excluded_file = output_file_base + '.toomany'
+  command = [binary_path]
+  command.extend(['-a'])
+  command.extend(['-p', str(bowtie_parallelism)])
+  command.extend(['-v', str(bowtie_error_tolerance)])
+  command.extend(['-m', str(bowtie_max_matches)])
+  command.extend(['--sam'])
+  # Memory-map the index so concurrent bowtie processes on this host share
+  # one copy through the page cache instead of each loading their own.
+  command.extend(['--mm'])
+  command.extend(['--un', unmatchable_seqs])
+  command.extend(['--max', max_excluded_file])
+  # These two are actual arguments, and need to be last.
+  command.extend([genome])
+  command.extend([','.join(input_files)])
+  logging.info(' '.join(command))
+  bowtie = subprocess.Popen(command,
+                            stdout=subprocess.PIPE,
+                            stderr=bowtie_stderr_log)
+  shard_files = {}
+  _, total_aligned = shard_alignments_by_chrom.shard_sam_stream(
+      bowtie.stdout, shard_files, output_file_base)
+  bowtie.stdout.close()
+  for f in shard_files.values():
+    f.close()
+  if bowtie.wait() != 0:
+    raise subprocess.CalledProcessError(bowtie.returncode, command)
+  shard_alignments_by_chrom.sort_shard_files(
+      [f.name for f in shard_files.values()])
+  logging.info('total_aligned: {0}.'.format(total_aligned))
+  shard_alignments_by_chrom.write_count_file(output_file_base, total_aligned)
+  return total_aligned
+
+
 ##############################################
 if __name__ == "__main__":
     sys.exit(main())
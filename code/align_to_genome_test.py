@@ -4,6 +4,7 @@
 
 import align_to_genome as atg
 
+import itertools
 import logging
 import unittest
 import os
@@ -17,30 +18,45 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 
-def generate_alignments(genome, reads, use_tophat):
-  alignments = None
-  test_dir = tempfile.mkdtemp(dir='/tmp')
-  logging.info('Working in {0}.'.format(test_dir))
-  file_base = os.path.join(test_dir, 'test')
-  fastq_name = file_base + '.fastq'
-  fasta_name = file_base + '.fna'
-  with open(fastq_name, 'w') as fastq_file:
-    for n, r in enumerate(reads):
-      name = 'seq{0}qes'.format(n)
-      s = HTSeq.SequenceWithQualities(r, name, 'B' * len(r))
-      s.write_to_fastq_file(fastq_file)
+def build_genome_index(genome):
+  """Write genome to a fasta file and build a bowtie index for it.
+
+  Returns (index_base, fasta_name).  Index construction is the expensive
+  part of fixture setup, so callers should build once and reuse.
+  """
+  index_dir = tempfile.mkdtemp(dir='/tmp')
+  logging.info('Building index in {0}.'.format(index_dir))
+  index_base = os.path.join(index_dir, 'genome')
+  fasta_name = index_base + '.fna'
   with open(fasta_name, 'w') as fasta_file:
     fasta_file.write('>chrFOO\n')
     fasta_file.write(genome)
   command = ['bowtie-build']
   command.append(fasta_name)
-  command.append(file_base)
+  command.append(index_base)
   logging.info(' '.join(command))
-  with open(file_base + '.bowtie_build_stdout', 'w') as bowtie_stdout:
-    with open(file_base + '.bowtie_build_stderr', 'w') as bowtie_stderr:
+  with open(index_base + '.bowtie_build_stdout', 'w') as bowtie_stdout:
+    with open(index_base + '.bowtie_build_stderr', 'w') as bowtie_stderr:
       subprocess.check_call(command,
                             stdout=bowtie_stdout,
                             stderr=bowtie_stderr)
+  return index_base, fasta_name
+
+
+def generate_alignments(index_base, fasta_name, reads, use_tophat):
+  """Run an alignment and return a lazy iterator over the results.
+
+  Callers should islice off however many alignments they actually want to
+  inspect rather than materializing the whole run.
+  """
+  test_dir = tempfile.mkdtemp(dir='/tmp')
+  logging.info('Working in {0}.'.format(test_dir))
+  file_base = os.path.join(test_dir, 'test')
+  fastq_name = file_base + '.fastq'
+  with open(fastq_name, 'w') as fastq_file:
+    for n, r in enumerate(reads):
+      fastq_file.write(
+          '@seq{0}qes\n{1}\n+\n{2}\n'.format(n, r, 'B' * len(r)))
   if use_tophat:
     align_to_genome = atg.align_with_tophat
     binary_path = 'tophat'
@@ -48,12 +64,16 @@ def generate_alignments(genome, reads, use_tophat):
     align_to_genome = atg.align_with_bowtie
     binary_path = 'bowtie'
   alignment_file = align_to_genome([fastq_name],
-                                   file_base,
+                                   index_base,
                                    binary_path,
                                    7, 3, 5, 12, 5000,
                                    fasta_name,
                                    file_base)
-  return [x for x in HTSeq.SAM_Reader(alignment_file)]
+  if alignment_file.endswith('.bam'):
+    reader = HTSeq.BAM_Reader(alignment_file)
+  else:
+    reader = HTSeq.SAM_Reader(alignment_file)
+  return iter(reader)
 
 
 def set_nth(read, n, base):
@@ -61,16 +81,24 @@ def set_nth(read, n, base):
 
 
 class TestEndToEnd(unittest.TestCase):
-  def setUp(self):
-    self.genome_plus_strand = 'AAAAAAAAAAAAACCCCCCAAAACAAAAAAAAAAAAAAAAAAAA'
+  genome_plus_strand = 'AAAAAAAAAAAAACCCCCCAAAACAAAAAAAAAAAAAAAAAAAA'
 
+  @classmethod
+  def setUpClass(cls):
+    # Every test aligns against the same tiny genome, so pay for
+    # bowtie-build once instead of once per test method.
+    cls.index_base, cls.fasta_name = build_genome_index(
+        cls.genome_plus_strand)
+
+  def setUp(self):
     self.plus_read = 'AAAAAAAAAAAAACCCCCCAAAACAAAAAAAAAA'
     self.minus_read = 'TTTTTTTTTTTTTTTTGTTTTGGGGGGTTTTTTT'
 
   def testTrivialBowtieRun(self):
     logging.info('Begin testTrivialBowtieRun')
     reads = [self.plus_read, self.minus_read]
-    alignments = generate_alignments(self.genome_plus_strand, reads, False)
+    alignments = list(itertools.islice(
+        generate_alignments(self.index_base, self.fasta_name, reads, False), 10))
     self.assertEqual(2, len(alignments))
     self.assertEqual(0, alignments[0].iv.start)
     self.assertEqual(34, alignments[0].iv.end)
@@ -80,7 +108,8 @@ class TestEndToEnd(unittest.TestCase):
   def testTrivialTophatRun(self):
     logging.info('Begin testTrivialTophatRun')
     reads = [self.plus_read, self.minus_read]
-    alignments = generate_alignments(self.genome_plus_strand, reads, True)
+    alignments = list(itertools.islice(
+        generate_alignments(self.index_base, self.fasta_name, reads, True), 10))
     self.assertEqual(2, len(alignments))
     self.assertEqual(0, alignments[0].iv.start)
     self.assertEqual(34, alignments[0].iv.end)
@@ -96,7 +125,8 @@ class TestEndToEnd(unittest.TestCase):
     minus_read = set_nth(minus_read, -4, 'C')
     minus_read = set_nth(minus_read, -10, 'A')
     reads = [plus_read, minus_read]
-    alignments = generate_alignments(self.genome_plus_strand, reads, False)
+    alignments = list(itertools.islice(
+        generate_alignments(self.index_base, self.fasta_name, reads, False), 10))
     self.assertEqual(2, len(alignments))
 
     self.assertEqual(0, alignments[0].iv.start)
@@ -125,7 +155,8 @@ class TestEndToEnd(unittest.TestCase):
     minus_read = set_nth(minus_read, -4, 'C')
     minus_read = set_nth(minus_read, -10, 'A')
     reads = [plus_read, minus_read]
-    alignments = generate_alignments(self.genome_plus_strand, reads, True)
+    alignments = list(itertools.islice(
+        generate_alignments(self.index_base, self.fasta_name, reads, True), 10))
     self.assertEqual(2, len(alignments))
 
     self.assertEqual(0, alignments[0].iv.start)
@@ -2,11 +2,14 @@
 
 # Author: John Hawkins (jsh)
 
+import argparse
 import logging
-import optparse
+import multiprocessing
 import os
 import subprocess
 import sys
+import tempfile
+import time
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -14,104 +17,170 @@ logging.basicConfig(level=logging.INFO,
 
 def main():
   logging.info('Parsing command line.')
-  usage = '%prog [options] input_file [...]'
-  parser = optparse.OptionParser(usage=usage)
-  parser.add_option(
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
       '--skip_trna',
-      action='store_true', dest='skip_trna',
-      default=False,
+      action='store_true',
       help='If set, don\'t bother filtering trna.')
-  parser.add_option(
-      '--bowtie_path', type='string',
-      action='store', dest='bowtie_path',
+  parser.add_argument(
+      '--bowtie_path',
       default='bowtie',
       help='Path to bowtie binary.')
-  parser.add_option(
-      '--bowtie_parallelism', type='int',
-      action='store', dest='bowtie_parallelism',
+  parser.add_argument(
+      '--bowtie_parallelism', type=int,
       default=7,
       help='Tell bowtie to run with this many parallel processes.')
-  parser.add_option(
-      '--bowtie_error_tolerance', type='int',
-      action='store', dest='bowtie_error_tolerance',
+  parser.add_argument(
+      '--bowtie_error_tolerance', type=int,
       default=3,
       help='Allow at most this many errors in bowtie alignments.')
-  parser.add_option(
-      '--bowtie_max_matches', type='int',
-      action='store', dest='bowtie_max_matches',
+  parser.add_argument(
+      '--bowtie_max_matches', type=int,
       default=5,
       help='If there are more matches than this give up and write to .max.')
-  parser.add_option(
-      '--trna_index', type='string',
-      action='store', dest='trna_index',
+  parser.add_argument(
+      '--trna_index',
       default='models/sc_tRNA_snoRNA',
       help='Path to bowtie index of tRNA to be removed.')
-  parser.add_option(
-      '--rrna_index', type='string',
-      action='store', dest='rrna_index',
+  parser.add_argument(
+      '--rrna_index',
       default='models/rrna',
       help='Path to bowtie index of rRNA to be removed.')
-  (options, args) = parser.parse_args()
+  parser.add_argument('input_files', nargs='+', metavar='input_file')
+  options = parser.parse_args()
+  args = options.input_files
 
   logging.info('Processing input.')
-  for input_file in args:
-    logging.info('Processing file: {0}'.format(input_file))
-    if options.skip_trna:
-      trna_free_file = input_file
-    else:
-      trna_free_file = filter_trna(input_file,
-                                   options.trna_index,
-                                   options.bowtie_path,
-                                   options.bowtie_parallelism,
-                                   options.bowtie_error_tolerance,
-                                   options.bowtie_max_matches)
-    rrna_free_file = filter_rrna(trna_free_file,
+  # Each bowtie only uses bowtie_parallelism threads, so fan out across input
+  # files with whatever cores are left over.
+  total_cores = multiprocessing.cpu_count()
+  n_workers = min(len(args),
+                  max(1, total_cores // options.bowtie_parallelism))
+  if n_workers > 1:
+    results = []
+    pool = multiprocessing.Pool(processes=n_workers)
+    for input_file in args:
+      results.append(pool.apply_async(process_one_file,
+                                      [input_file, options]))
+    pool.close()
+    pool.join()
+    for r in results:
+      r.get()
+  else:
+    for input_file in args:
+      process_one_file(input_file, options)
+
+
+def process_one_file(input_file, options):
+  """Run the tRNA and rRNA filters, in order, over one input file."""
+  logging.info('Processing file: {0}'.format(input_file))
+  if options.skip_trna:
+    rrna_free_file = filter_rrna(input_file,
                                  options.rrna_index,
                                  options.bowtie_path,
                                  options.bowtie_parallelism,
                                  options.bowtie_error_tolerance,
                                  options.bowtie_max_matches)
-    logging.info('Cleaned sequence file: {0}'.format(rrna_free_file))
+  else:
+    rrna_free_file = filter_trna_then_rrna(input_file,
+                                           options.trna_index,
+                                           options.rrna_index,
+                                           options.bowtie_path,
+                                           options.bowtie_parallelism,
+                                           options.bowtie_error_tolerance,
+                                           options.bowtie_max_matches)
+  logging.info('Cleaned sequence file: {0}'.format(rrna_free_file))
 
 
-def filter_trna(input_file,
-                trna_index,
-                bowtie_path,
-                bowtie_parallelism,
-                bowtie_error_tolerance,
-                bowtie_max_matches):
-  """Remove tRNA from sequence file.
+def filter_trna_then_rrna(input_file,
+                          trna_index,
+                          rrna_index,
+                          bowtie_path,
+                          bowtie_parallelism,
+                          bowtie_error_tolerance,
+                          bowtie_max_matches):
+  """Remove tRNA and then rRNA from sequence file in one streamed pass.
+
+  The tRNA bowtie's unaligned reads feed the rRNA bowtie through a named
+  FIFO, so the big tRNA-free intermediate never lands on disk.
   Args:
     input_file: Path to fastq file to be processed.
-    trna_index: The bowtie index of the RNA to strip out.
+    trna_index: The bowtie index of the tRNA to strip out.
+    rrna_index: The bowtie index of the rRNA to strip out.
     bowtie_path: Path to the bowtie binary.
     bowtie_parallelism: Number of processes bowtie should use.
     bowtie_error_tolerance: Number of alignment errors tolerated per sequence.
     bowtie_max_matches: Maximum allowable matches before fail-fast.
   Returns:
-    output_file: Name of the file to which tRNA-free sequences are written.
+    output_file: Name of the file to which tRNA/rRNA-free sequences are
+        written.
   """
-  logging.info('Removing tRNA from: {0}'.format(input_file))
-  matched_trna_file = open(os.path.splitext(input_file)[0] + '.trna', 'w')
-  bowtie_error_log = open(
-      os.path.splitext(input_file)[0] + '.bowtie_err_trna', 'w')
-  output_file = os.path.splitext(input_file)[0] + '.trna_free'
-  max_excluded_file = os.path.splitext(input_file)[0] + '.trna_toomany'
-  command = [bowtie_path]
-  command.extend(['-a'])
-  command.extend(['-p', str(bowtie_parallelism)])
-  command.extend(['-v', str(bowtie_error_tolerance)])
-  command.extend(['-m', str(bowtie_max_matches)])
-  command.extend(['--nofw'])
-  command.extend(['--un', output_file])
-  command.extend(['--max', max_excluded_file])
+  logging.info('Removing tRNA and rRNA from: {0}'.format(input_file))
+  file_base = os.path.splitext(input_file)[0]
+  matched_trna_file = open(file_base + '.trna', 'w')
+  matched_rrna_file = open(file_base + '.rrna', 'w')
+  trna_error_log = open(file_base + '.bowtie_err_trna', 'w')
+  rrna_error_log = open(file_base + '.bowtie_err_rrna', 'w')
+  output_file = file_base + '.trna_rrna_free'
+  # bowtie wants filenames for --un and -q input, so the pipe between the two
+  # stages has to be a named FIFO.
+  fifo_dir = tempfile.mkdtemp()
+  trna_free_fifo = os.path.join(fifo_dir, 'trna_free')
+  os.mkfifo(trna_free_fifo)
+  trna_command = [bowtie_path]
+  trna_command.extend(['-a'])
+  trna_command.extend(['-p', str(bowtie_parallelism)])
+  trna_command.extend(['-v', str(bowtie_error_tolerance)])
+  trna_command.extend(['-m', str(bowtie_max_matches)])
+  trna_command.extend(['--nofw'])
+  trna_command.extend(['--mm'])
+  trna_command.extend(['--un', trna_free_fifo])
+  trna_command.extend(['--max', file_base + '.trna_toomany'])
   # These two are actual arguments, and need to be last.
-  command.extend([trna_index])
-  command.extend([input_file])
-  logging.info(' '.join(command))
-  subprocess.check_call(command,
-                        stdout=matched_trna_file,
-                        stderr=bowtie_error_log)
+  trna_command.extend([trna_index])
+  trna_command.extend([input_file])
+  rrna_command = [bowtie_path]
+  rrna_command.extend(['-a'])
+  rrna_command.extend(['-p', str(bowtie_parallelism)])
+  rrna_command.extend(['-v', str(bowtie_error_tolerance)])
+  rrna_command.extend(['-m', str(bowtie_max_matches)])
+  rrna_command.extend(['--nofw'])
+  rrna_command.extend(['--mm'])
+  rrna_command.extend(['--un', output_file])
+  rrna_command.extend(['--max', file_base + '.rrna_toomany'])
+  # These two are actual arguments, and need to be last.
+  rrna_command.extend([rrna_index])
+  rrna_command.extend([trna_free_fifo])
+  logging.info(' '.join(trna_command))
+  logging.info(' '.join(rrna_command))
+  trna_bowtie = subprocess.Popen(trna_command,
+                                 stdout=matched_trna_file,
+                                 stderr=trna_error_log)
+  rrna_bowtie = subprocess.Popen(rrna_command,
+                                 stdout=matched_rrna_file,
+                                 stderr=rrna_error_log)
+  try:
+    # The two bowties are only healthy together: if either dies early
+    # (bad index, typo'd path), its sibling can block forever on the
+    # FIFO.  Poll both, and take the survivor down before reporting a
+    # failure instead of waiting on a process that will never finish.
+    stages = [(trna_bowtie, trna_command), (rrna_bowtie, rrna_command)]
+    while any(bowtie.poll() is None for bowtie, _ in stages):
+      for bowtie, command in stages:
+        returncode = bowtie.poll()
+        if returncode is not None and returncode != 0:
+          for other, _ in stages:
+            if other.poll() is None:
+              other.kill()
+              other.wait()
+          raise subprocess.CalledProcessError(returncode, command)
+      time.sleep(1)
+    for bowtie, command in stages:
+      if bowtie.returncode != 0:
+        raise subprocess.CalledProcessError(bowtie.returncode, command)
+  finally:
+    os.remove(trna_free_fifo)
+    os.rmdir(fifo_dir)
   return output_file
 
 
@@ -144,6 +213,7 @@ def filter_rrna(input_file,
   command.extend(['-v', str(bowtie_error_tolerance)])
   command.extend(['-m', str(bowtie_max_matches)])
   command.extend(['--nofw'])
+  command.extend(['--mm'])
   command.extend(['--un', output_file])
   command.extend(['--max', max_excluded_file])
   # These two are actual arguments, and need to be last.
@@ -2,84 +2,195 @@
 
 # Author: John Hawkins (jsh)
 
-import itertools
+import argparse
+import io
 import logging
-import math
-import numpy
-import optparse
+import multiprocessing.dummy
 import os
-import string
+import subprocess
 import sys
 
-import HTSeq
-
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 
+# "Chromosomes" we never want in the output shards.
+SKIP_CHROMS = frozenset(('chrMito', '2-micron'))
+
+
 def main():
   logging.info('Parsing command line.')
-  usage = '%prog [options] input_file [...] output_file_base'
-  parser = optparse.OptionParser(usage=usage)
-  (options, args) = parser.parse_args()
-  input_files = args[:-1]
-  if not input_files:
-    binary = os.path.basename(sys.argv[0])
-    logging.fatal(
-        '{0} saw only one input argument, expecting 2 or more'.format(binary))
+  parser = argparse.ArgumentParser()
+  parser.add_argument('input_files', nargs='+', metavar='input_file')
+  parser.add_argument('output_file_base')
+  args = parser.parse_args()
+  if missing_files(args.input_files):
     return 2
-  output_file_base = args[-1]
-  for input_file in input_files:
-    if not os.path.exists(input_file):
-      logging.fatal('No such file: {0}'.format(input_file))
-      return 2
-  process_input_files(input_files, output_file_base)
+  process_input_files(args.input_files, args.output_file_base)
+
+
+def missing_files(input_files):
+  """Log any input files that don't exist, overlapping the stat calls.
+
+  On a network filesystem a prior fan-out can leave hundreds of shards to
+  check, and the serial stat round-trips add up.
+  """
+  pool = multiprocessing.dummy.Pool(processes=min(16, len(input_files)))
+  exists = pool.map(os.path.exists, input_files)
+  pool.close()
+  pool.join()
+  missing = [f for f, ok in zip(input_files, exists) if not ok]
+  for input_file in missing:
+    logging.fatal('No such file: %s', input_file)
+  return missing
 
 
 def process_input_files(input_files,
                         output_file_base):
-  """Generate wiggle files for one input file.
+  """Generate per-chromosome shard files for the input alignments.
 
-  Build the coverage/mismatch arrays from individual alignment positions, and
-  write out the plus and minus directional bedgraph/wiggle files.
+  The SAM text is streamed directly: consecutive lines are grouped by QNAME
+  and only the columns select_alignment_line needs (FLAG, RNAME) are parsed.
+  Selected lines pass through to their shard byte-for-byte, with no per-line
+  alignment object construction.
   """
   n_seen = 0
   total_aligned = 0
   shard_files = {}
   for input_file in input_files:
-    logging.info('Processing file: {0}'.format(input_file))
-    sam_alignments = HTSeq.SAM_Reader(input_file)
-    groups = itertools.groupby(sam_alignments, lambda x: x.read.name)
-    for name, grouper in groups:
+    logging.info('Processing file: %s', input_file)
+    if input_file.endswith('.bam'):
+      # Tophat alignments stay in BAM now; decode to SAM text on the fly.
+      view_command = ['samtools', 'view', input_file]
+      view = subprocess.Popen(view_command, stdout=subprocess.PIPE)
+      stream = view.stdout
+    else:
+      view = None
+      stream = open(input_file, 'rb')
+    n_seen, total_aligned = shard_sam_stream(stream,
+                                             shard_files,
+                                             output_file_base,
+                                             n_seen,
+                                             total_aligned)
+    stream.close()
+    if view is not None and view.wait() != 0:
+      raise subprocess.CalledProcessError(view.returncode, view_command)
+  for f in shard_files.values():
+    f.close()
+  sort_shard_files([f.name for f in shard_files.values()])
+  logging.info('total_aligned: %d.', total_aligned)
+  write_count_file(output_file_base, total_aligned)
+
+
+def shard_sam_stream(stream,
+                     shard_files,
+                     output_file_base,
+                     n_seen=0,
+                     total_aligned=0):
+  """Shard one stream of SAM text lines, updating shard_files in place.
+
+  Returns the updated (n_seen, total_aligned) counters so callers can
+  carry them across streams.
+  """
+  current_name = None
+  group = []
+  for line in stream:
+    if line.startswith(b'@'):
+      continue
+    name = line.split(b'\t', 1)[0]
+    if name != current_name:
+      total_aligned += shard_alignment_group(group,
+                                             shard_files,
+                                             output_file_base)
+      group = []
+      current_name = name
       n_seen += 1
       if n_seen % 1000000 == 0:
-        logging.info('Now sharding group #{n_seen} {name}.'.format(**vars()))
-      alignments = list(grouper)
-      alignment = select_alignment(alignments)
-      if alignment:
-        shard = alignment.iv.chrom
-        if shard in ['chrMito', '2-micron']:
-          continue
-        if not shard_files.has_key(shard):
-          shard_files[shard] = open(
-              output_file_base + '.alignment.sam.shard.{0}'.format(shard), 'w')
-        broken = alignment.get_sam_line()
-        fixed = broken.translate(string.maketrans(' ', '\t'))
-        shard_files[shard].write(fixed + '\n')
-        total_aligned += 1
-  logging.info('total_aligned: {total_aligned}.'.format(**vars()))
+        logging.info('Now sharding group #%d %s.', n_seen, name)
+    group.append(line)
+  total_aligned += shard_alignment_group(group,
+                                         shard_files,
+                                         output_file_base)
+  return n_seen, total_aligned
+
+
+def sort_shard_files(shard_names):
+  """Sort each completed shard by (FLAG, POS), in place.
+
+  analyze_shards streams each shard through a windowed accumulator that
+  flushes whenever the strand flips and assumes positions only grow, so
+  a shard must hold all plus-strand alignments before all minus-strand
+  ones, each run monotone in position -- the ordering the old FLAG-keyed
+  GNU sort guaranteed globally.  samtools sort orders by position only,
+  interleaving strands, so restore the grouping here where the files are
+  small and the sorts can run in parallel.
+  """
+  if not shard_names:
+    return
+  pool = multiprocessing.dummy.Pool(processes=min(8, len(shard_names)))
+  results = []
+  for shard_name in shard_names:
+    results.append(pool.apply_async(sort_shard_file, [shard_name]))
+  pool.close()
+  pool.join()
+  for r in results:
+    r.get()
+
+
+def sort_shard_file(shard_name):
+  """Sort one shard file in place by (FLAG, POS)."""
+  command = ['sort']
+  command.extend(['-t', '\t'])
+  command.extend(['-k', '2n,2'])
+  command.extend(['-k', '4n,4'])
+  command.extend(['-o', shard_name])
+  command.append(shard_name)
+  logging.info(' '.join(command))
+  subprocess.check_call(command)
+
+
+def write_count_file(output_file_base, total_aligned):
+  """Record the total aligned count for downstream normalization."""
   count_file = open(output_file_base + '.alignment.sam.count', 'w')
   count_file.write(str(total_aligned))
   count_file.write('\n')
   count_file.close()
 
 
-def select_alignment(alignments):
-  """Return unique alignment, or None."""
-  alignments = [x for x in alignments if x.aligned]
-  alignments = [x for x in alignments if not '_' in x.iv.chrom]
-  if len(alignments) == 1:
-    return alignments[0]
+def shard_alignment_group(group_lines, shard_files, output_file_base):
+  """Route one QNAME group's alignment to its chromosome shard.
+
+  Returns the number of alignments written (1 or 0), for tallying.
+  """
+  selected = select_alignment_line(group_lines)
+  if selected is None:
+    return 0
+  line, rname = selected
+  shard = rname.decode('ascii')
+  if shard in SKIP_CHROMS:
+    return 0
+  if not shard in shard_files:
+    # A big buffer here batches the many small per-line writes into ~1 MiB
+    # syscalls.
+    shard_files[shard] = io.open(
+        output_file_base + '.alignment.sam.shard.{0}'.format(shard), 'wb',
+        buffering=1 << 20)
+  shard_files[shard].write(line)
+  return 1
+
+
+def select_alignment_line(group_lines):
+  """Return (raw line, RNAME) for a unique usable alignment, or None."""
+  kept = []
+  for line in group_lines:
+    fields = line.split(b'\t', 4)
+    if int(fields[1]) & 0x4:
+      continue  # Unaligned.
+    if b'_' in fields[2]:
+      continue
+    kept.append((line, fields[2]))
+  if len(kept) == 1:
+    return kept[0]
   else:
     return None
 
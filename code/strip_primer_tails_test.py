@@ -6,131 +6,118 @@ import strip_primer_tails as strip
 
 import unittest
 
-from Bio.SeqRecord import SeqRecord
-from Bio.Seq import Seq
-
-def same_sequence(a, b):
-  qa = a.letter_annotations['phred_quality']
-  qb = b.letter_annotations['phred_quality']
-  return str(a) == str(b) and qa == qb
 
 class TestCleaningAndStripping(unittest.TestCase):
   def setUp(self):
-    self.inequality_error = (
-        '\n{0:fastq-illumina} and \n{1:fastq-illumina} were not equal.')
     self.min_primer_match = 10
     self.max_primer_offset = 1
     self.min_sequence_len = 18
+    # Phred 2 encodes as 'B' under fastq-illumina.
+    self.phred2 = 'B'
     self.primer = 'TCGTATGCCGTCTTCTGCTTG'
-    self.primer_seq = SeqRecord(self.primer)
-    primer_annotations = [10] * len(self.primer_seq)
-    self.primer_seq.letter_annotations['phred_quality'] = primer_annotations
-    self.baseline = SeqRecord('TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT')
-    allswell = [33] * 41
-    self.baseline.letter_annotations['phred_quality'] = allswell
+    self.baseline = ('baseline', 'T' * 41, 'h' * 41)
 
   def testTrivialCleaning(self):
-    cleaned = strip.clean_for_illumina_flag(self.baseline)
-    self.assertTrue(same_sequence(cleaned, self.baseline),
-        self.inequality_error.format(cleaned, self.baseline))
+    cleaned = strip.clean_for_illumina_flag(self.baseline, self.phred2)
+    self.assertEqual(self.baseline, cleaned)
 
   def testHappyCleaning(self):
-    bad_tail = [2] * 5
-    self.baseline.letter_annotations['phred_quality'][-5:] = bad_tail
-    cleaned = strip.clean_for_illumina_flag(self.baseline)
-    self.assertTrue(same_sequence(cleaned, self.baseline[:-5]),
-        self.inequality_error.format(cleaned, self.baseline))
-
-  def testRFindIfNot(self):
-    tagger = lambda x: x == 2
-    things = [1,1,2,1,2,2]
-    self.assertEqual(3, strip.rfind_if_not(tagger, things))
-    things = [1,1,1]
-    self.assertEqual(2, strip.rfind_if_not(tagger, things))
+    title, seq, qual = self.baseline
+    record = (title, seq, qual[:-5] + self.phred2 * 5)
+    cleaned = strip.clean_for_illumina_flag(record, self.phred2)
+    self.assertEqual((title, seq[:-5], qual[:-5]), cleaned)
 
   def testInternalBadReadSkippedByCleaning(self):
-    bad_tail = [2] * 5
-    self.baseline.letter_annotations['phred_quality'][-5:] = bad_tail
-    self.baseline.letter_annotations['phred_quality'][5:10] = bad_tail
-    self.assertEqual(36, len(strip.clean_for_illumina_flag(self.baseline)))
+    title, seq, qual = self.baseline
+    marred = qual[:5] + self.phred2 * 5 + qual[10:-5] + self.phred2 * 5
+    cleaned = strip.clean_for_illumina_flag((title, seq, marred), self.phred2)
+    self.assertEqual((title, seq[:-5], marred[:-5]), cleaned)
 
   def testTrivialTrimming(self):
     trimmed = strip.trim_primer(self.primer, self.baseline,
-                                self.min_primer_match, self.max_primer_offset)
-    self.assertTrue(same_sequence(trimmed, self.baseline),
-        self.inequality_error.format(trimmed, self.baseline))
+                                self.min_primer_match,
+                                self.max_primer_offset)
+    self.assertEqual(self.baseline, trimmed)
 
   def testSimpleTrimming(self):
-    self.baseline = self.baseline[:-len(self.primer)] + self.primer_seq
-    trimmed = strip.trim_primer(self.primer, self.baseline,
-                                self.min_primer_match, self.max_primer_offset)
-    self.assertTrue(same_sequence(trimmed, self.baseline[:-len(self.primer)]),
-        self.inequality_error.format(trimmed, self.baseline))
+    title, seq, qual = self.baseline
+    record = (title, seq[:-len(self.primer)] + self.primer, qual)
+    trimmed = strip.trim_primer(self.primer, record,
+                                self.min_primer_match,
+                                self.max_primer_offset)
+    keep = len(seq) - len(self.primer)
+    self.assertEqual((title, seq[:keep], qual[:keep]), trimmed)
 
   def testRNASeqTrimming(self):
     read = 'CATTCTGTGGAACGGTCCGGTTGGCGCTGTAGGCACCATCAATTCGTATG'
-    self.primer_seq = SeqRecord(read)
-    self.primer_seq.letter_annotations['phred_quality'] = [10] * len(read)
     primer = 'CTGTAGGCACCATCAAT'
     goal = 'CATTCTGTGGAACGGTCCGGTTGGCG'
-    goal_seq = SeqRecord(goal)
-    goal_seq.letter_annotations['phred_quality'] = [10] * len(goal)
-    trimmed = strip.trim_primer(primer, self.primer_seq,
-                                self.min_primer_match, self.max_primer_offset)
-    self.assertTrue(same_sequence(trimmed, goal_seq),
-        self.inequality_error.format(trimmed, self.baseline))
+    record = ('read', read, 'h' * len(read))
+    trimmed = strip.trim_primer(primer, record,
+                                self.min_primer_match,
+                                self.max_primer_offset)
+    self.assertEqual(('read', goal, 'h' * len(goal)), trimmed)
 
   def testIgnoredShortPrimerTrimming(self):
-    self.baseline = self.baseline[:-5] + self.primer_seq[:5]
-    trimmed = strip.trim_primer(self.primer, self.baseline,
-                                self.min_primer_match, self.max_primer_offset)
-    self.assertTrue(same_sequence(trimmed, self.baseline),
-        self.inequality_error.format(trimmed, self.baseline))
+    title, seq, qual = self.baseline
+    record = (title, seq[:-5] + self.primer[:5], qual)
+    trimmed = strip.trim_primer(self.primer, record,
+                                self.min_primer_match,
+                                self.max_primer_offset)
+    self.assertEqual(record, trimmed)
 
   def testIgnoredOffsetPrimerTrimming(self):
-    self.baseline = self.baseline[:-12] + self.primer_seq[4:16]
-    trimmed = strip.trim_primer(self.primer, self.baseline,
-                                self.min_primer_match, self.max_primer_offset)
-    self.assertTrue(same_sequence(trimmed, self.baseline),
-        self.inequality_error.format(trimmed, self.baseline))
-
-  def testTrivialProcessSequences(self):
-    processed = strip.processed_sequences(self.primer, [self.baseline],
-                                          self.min_sequence_len,
-                                          self.min_primer_match,
-                                          self.max_primer_offset).next()
-    self.assertTrue(same_sequence(processed, self.baseline),
-        self.inequality_error.format(processed, self.baseline))
+    title, seq, qual = self.baseline
+    record = (title, seq[:-12] + self.primer[4:16], qual)
+    trimmed = strip.trim_primer(self.primer, record,
+                                self.min_primer_match,
+                                self.max_primer_offset)
+    self.assertEqual(record, trimmed)
+
+  def testTrivialProcessOne(self):
+    processed = strip.process_one(self.baseline, self.primer,
+                                  self.min_sequence_len,
+                                  self.min_primer_match,
+                                  self.max_primer_offset,
+                                  self.phred2)
+    self.assertEqual(self.baseline, processed)
 
   def testTrimAndClean(self):
-    s = self.baseline[:28] + self.primer_seq[:12]
-    s.letter_annotations['phred_quality'][-20:] = [2] * 20
-    processed = strip.processed_sequences(self.primer, [s],
-                                          self.min_sequence_len,
-                                          self.min_primer_match,
-                                          self.max_primer_offset).next()
-    self.assertTrue(same_sequence(processed, s[:20]),
-        self.inequality_error.format(processed, s[:20]))
+    title, seq, qual = self.baseline
+    record = (title, seq[:28] + self.primer[:12],
+              qual[:20] + self.phred2 * 20)
+    processed = strip.process_one(record, self.primer,
+                                  self.min_sequence_len,
+                                  self.min_primer_match,
+                                  self.max_primer_offset,
+                                  self.phred2)
+    self.assertEqual((title, seq[:20], qual[:20]), processed)
 
   def testTooSmallAfterTrimming(self):
-    l = len(self.primer_seq) + 15
-    s = self.baseline[:15] + self.primer_seq + self.baseline[l:]
-    s.letter_annotations['phred_quality'][-5:] = [2] * 5
-    processed = strip.processed_sequences(self.primer, [s],
-                                          self.min_sequence_len,
-                                          self.min_primer_match,
-                                          self.max_primer_offset)
-    self.assertEqual([], list(processed))
+    title, seq, qual = self.baseline
+    tail_len = len(seq) - 15 - len(self.primer)
+    record = (title, seq[:15] + self.primer + seq[:tail_len], qual)
+    processed = strip.process_one(record, self.primer,
+                                  self.min_sequence_len,
+                                  self.min_primer_match,
+                                  self.max_primer_offset,
+                                  self.phred2)
+    self.assertIsNone(processed)
 
   def testTooSmallAfterCleaning(self):
-    bad_tail = [2] * (len(self.baseline) - 16)
-    self.baseline.letter_annotations['phred_quality'][16:] = bad_tail
-    processed = strip.processed_sequences(self.primer, [self.baseline],
-                                          self.min_sequence_len,
-                                          self.min_primer_match,
-                                          self.max_primer_offset)
-    self.assertEqual([], list(processed))
+    title, seq, qual = self.baseline
+    record = (title, seq, qual[:16] + self.phred2 * (len(qual) - 16))
+    processed = strip.process_one(record, self.primer,
+                                  self.min_sequence_len,
+                                  self.min_primer_match,
+                                  self.max_primer_offset,
+                                  self.phred2)
+    self.assertIsNone(processed)
+
+  def testIlluminaToSanger(self):
+    self.assertEqual('!+5', '@JT'.translate(strip.ILLUMINA_TO_SANGER))
 
 
+##############################################
 if __name__ == '__main__':
   unittest.main()